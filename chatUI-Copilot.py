@@ -1,15 +1,20 @@
 # app.py
 import streamlit as st
+import streamlit.components.v1 as components
 import requests
 import uuid
 import sqlite3
 import json
-from datetime import datetime
-import pyperclip
 import os
 from dotenv import load_dotenv
 import contextlib
 import logging
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -22,35 +27,68 @@ API_URL = os.getenv('N8N_WEBHOOK_URL')
 BEARER_TOKEN = os.getenv('BEARER_TOKEN')
 DB_PATH = os.getenv('DB_PATH')
 
+# Number of exchanges shown per history page
+HISTORY_PAGE_SIZE = 100
+
+# Local wall-clock time with milliseconds, matching rows previously written via datetime.now()
+LOCAL_NOW = "strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')"
+
 # Validate required env vars
 if not all([API_URL, BEARER_TOKEN, DB_PATH]):
     raise ValueError("Missing required environment variables. Check .env file.")
 
+def connect():
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    # WAL lets the read connection (and other processes) read during a write; NORMAL syncs only at checkpoints
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    return conn
+
+@st.cache_resource
+def get_conn():
+    # Single long-lived write connection shared across reruns and script-runner threads
+    return connect()
+
+@st.cache_resource
+def get_read_conn():
+    # Reads get their own connection so they can't observe another thread's open write transaction
+    conn = connect()
+    conn.execute("PRAGMA query_only=ON")
+    return conn
+
+@st.cache_resource
+def get_write_lock():
+    return threading.Lock()
+
 @contextlib.contextmanager
-def get_db_connection():
-    conn = None
+def get_db_connection(read_only=False):
     try:
-        conn = sqlite3.connect(DB_PATH)
-        yield conn
+        yield get_read_conn() if read_only else get_conn()
     except sqlite3.Error as e:
         logger.error(f"Database error: {e}")
         raise
-    finally:
-        if conn:
-            conn.close()
 
+# Schema DDL only needs to run once per process, not on every rerun
+@st.cache_resource
 def init_db():
     try:
         with get_db_connection() as conn:
             c = conn.cursor()
             # Create sessions table
-            c.execute('''CREATE TABLE IF NOT EXISTS sessions
-                        (session_id TEXT PRIMARY KEY, created_at TIMESTAMP)''')
+            c.execute(f'''CREATE TABLE IF NOT EXISTS sessions
+                        (session_id TEXT PRIMARY KEY, created_at TIMESTAMP DEFAULT ({LOCAL_NOW}))''')
             # Create messages table
-            c.execute('''CREATE TABLE IF NOT EXISTS messages
+            c.execute(f'''CREATE TABLE IF NOT EXISTS messages
                         (id INTEGER PRIMARY KEY, session_id TEXT, 
-                         user_message TEXT, llm_response TEXT, timestamp TIMESTAMP,
+                         user_message TEXT, llm_response TEXT, timestamp TIMESTAMP DEFAULT ({LOCAL_NOW}),
                          FOREIGN KEY (session_id) REFERENCES sessions(session_id))''')
+            # Index for per-session history lookups
+            c.execute('''CREATE INDEX IF NOT EXISTS idx_messages_sid_ts
+                        ON messages (session_id, timestamp)''')
             conn.commit()
             logger.info("Database initialized successfully")
     except sqlite3.Error as e:
@@ -59,28 +97,33 @@ def init_db():
 
 def save_message(session_id, user_message, llm_response):
     try:
-        with get_db_connection() as conn:
+        # Commit, or roll back while still holding the write lock, via the connection context manager
+        with get_write_lock(), get_db_connection() as conn, conn:
             c = conn.cursor()
-            c.execute("INSERT INTO messages (session_id, user_message, llm_response, timestamp) VALUES (?, ?, ?, ?)", (session_id, user_message, llm_response, datetime.now()))
-            conn.commit()
+            c.execute(f"INSERT INTO messages (session_id, user_message, llm_response, timestamp) VALUES (?, ?, ?, {LOCAL_NOW})", (session_id, user_message, llm_response))
+        get_session_messages.clear()
     except sqlite3.Error as e:
         logger.error(f"Failed to save message: {e}")
         raise
 
+@st.cache_data(ttl=30, show_spinner=False)
 def get_sessions():
     try:
-        with get_db_connection() as conn:
+        with get_db_connection(read_only=True) as conn:
             c = conn.cursor()
             return c.execute("SELECT session_id, created_at FROM sessions ORDER BY created_at DESC").fetchall()
     except sqlite3.Error as e:
         logger.error(f"Failed to get sessions: {e}")
         raise
 
-def get_session_messages(session_id):
+@st.cache_data(ttl=30, show_spinner=False)
+def get_session_messages(session_id, limit=HISTORY_PAGE_SIZE):
     try:
-        with get_db_connection() as conn:
+        with get_db_connection(read_only=True) as conn:
             c = conn.cursor()
-            messages = c.execute("SELECT user_message, llm_response FROM messages WHERE session_id = ? ORDER BY timestamp", (session_id,)).fetchall()
+            # Newest page first, reversed in place into chronological order
+            messages = c.execute("SELECT id, user_message, llm_response FROM messages WHERE session_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?", (session_id, limit)).fetchall()
+            messages.reverse()
             return messages
     except sqlite3.Error as e:
         logger.error(f"Failed to get session messages: {e}")
@@ -88,10 +131,10 @@ def get_session_messages(session_id):
 
 def create_session(session_id):
     try:
-        with get_db_connection() as conn:
+        with get_write_lock(), get_db_connection() as conn, conn:
             c = conn.cursor()
-            c.execute("INSERT INTO sessions (session_id, created_at) VALUES (?, ?)", (session_id, datetime.now()))
-            conn.commit()
+            c.execute(f"INSERT INTO sessions (session_id, created_at) VALUES (?, {LOCAL_NOW})", (session_id,))
+        get_sessions.clear()
     except sqlite3.Error as e:
         logger.error(f"Failed to create session: {e}")
         raise
@@ -103,6 +146,8 @@ init_db()
 if 'session_id' not in st.session_state:
     st.session_state.session_id = str(uuid.uuid4())
     create_session(st.session_state.session_id)
+if 'history_limit' not in st.session_state:
+    st.session_state.history_limit = HISTORY_PAGE_SIZE
 
 # Streamlit UI
 st.title("Chat with LLM")
@@ -114,38 +159,87 @@ with st.sidebar:
     for session_id, created_at in sessions:
         if st.button(f"Session {session_id[:8]} - {created_at}"):
             st.session_state.session_id = session_id
-            st.experimental_rerun()
+            st.session_state.history_limit = HISTORY_PAGE_SIZE
+            st.rerun()
 
 # Chat interface
-def send_message(message):
-    headers = {
+@st.cache_resource
+def get_http_session():
+    # Keep-alive session so every message reuses the pooled webhook connection
+    session = requests.Session()
+    session.headers.update({
         "Authorization": f"Bearer {BEARER_TOKEN}",
         "Content-Type": "application/json"
-    }
+    })
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def encode_payload(payload):
+    # Serialize once up front and send raw bytes; orjson is used when installed
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode()
+
+def send_message(message):
     payload = {
         "sessionId": st.session_state.session_id,
         "chatInput": message
     }
-    response = requests.post(API_URL, headers=headers, json=payload)
-    return response.json()["output"]
+    try:
+        response = get_http_session().post(API_URL, data=encode_payload(payload), timeout=(3.05, 60))
+        response.raise_for_status()
+        return response.json()["output"]
+    except requests.exceptions.RequestException as e:
+        st.error(f"Error communicating with the server: {str(e)}")
+        return None
+
+def copy_button(text):
+    # Copy in the browser so no server round trip or OS clipboard tool is involved
+    # Escape "</" so the response text can't close the inline script
+    payload = json.dumps(text).replace("</", "<\\/")
+    components.html(
+        f'''<button id="copy">📋 Copy</button>
+<script>
+const button = document.getElementById("copy");
+button.addEventListener("click", () => {{
+    // navigator.clipboard is only available in secure contexts (HTTPS or localhost)
+    if (!navigator.clipboard) {{
+        button.innerText = "⚠️ Copy failed";
+        return;
+    }}
+    navigator.clipboard.writeText({payload})
+        .then(() => {{ button.innerText = "✅ Copied"; }})
+        .catch(() => {{ button.innerText = "⚠️ Copy failed"; }});
+}});
+</script>''',
+        height=32
+    )
+
+def action_buttons(mid, user_msg, llm_resp):
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("🔄 Retry", key=f"retry_{mid}"):
+            new_response = send_message(user_msg)
+            if new_response:
+                save_message(st.session_state.session_id, user_msg, new_response)
+                st.rerun()
+    with col2:
+        copy_button(llm_resp)
 
 # Display chat history
-messages = get_session_messages(st.session_state.session_id)
-for user_msg, llm_resp in messages:
+messages = get_session_messages(st.session_state.session_id, st.session_state.history_limit)
+if len(messages) == st.session_state.history_limit:
+    if st.button("Load earlier messages"):
+        st.session_state.history_limit += HISTORY_PAGE_SIZE
+        st.rerun()
+for mid, user_msg, llm_resp in messages:
     with st.chat_message("user"):
         st.write(user_msg)
     with st.chat_message("assistant"):
         st.write(llm_resp)
-        col1, col2 = st.columns(2)
-        with col1:
-            if st.button("🔄 Retry", key=f"retry_{hash(user_msg)}"):
-                new_response = send_message(user_msg)
-                save_message(st.session_state.session_id, user_msg, new_response)
-                st.experimental_rerun()
-        with col2:
-            if st.button("📋 Copy", key=f"copy_{hash(user_msg)}"):
-                pyperclip.copy(llm_resp)
-                st.toast("Response copied to clipboard!")
+        action_buttons(mid, user_msg, llm_resp)
 
 # Chat input
 if prompt := st.chat_input("Type your message here..."):
@@ -153,17 +247,9 @@ if prompt := st.chat_input("Type your message here..."):
         st.write(prompt)
     
     with st.chat_message("assistant"):
-        response = send_message(prompt)
-        st.write(response)
+        with st.spinner("Thinking..."):
+            response = send_message(prompt)
+    if response:
         save_message(st.session_state.session_id, prompt, response)
-        
-        col1, col2 = st.columns(2)
-        with col1:
-            if st.button("🔄 Retry", key=f"retry_{hash(prompt)}"):
-                new_response = send_message(prompt)
-                save_message(st.session_state.session_id, prompt, new_response)
-                st.experimental_rerun()
-        with col2:
-            if st.button("📋 Copy", key=f"copy_{hash(prompt)}"):
-                pyperclip.copy(response)
-                st.toast("Response copied to clipboard!")
\ No newline at end of file
+        # The history loop renders the new exchange, with its action buttons, on the rerun
+        st.rerun()
\ No newline at end of file
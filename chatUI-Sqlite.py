@@ -5,103 +5,226 @@ import requests
 import uuid
 import json
 import sqlite3
-from datetime import datetime
+import threading
+import queue
+import time
+import atexit
+import collections
+import logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Number of messages fetched and rendered per history page
+HISTORY_PAGE_SIZE = 100
+
+# Seconds the background writer waits to batch further messages into one commit
+WRITE_BATCH_WINDOW = 0.05
+
+# Attempts per batch before the writer gives up, and the initial (doubling) delay between them
+WRITE_RETRIES = 3
+WRITE_RETRY_BACKOFF = 0.5
+
+# Local wall-clock time with milliseconds, matching rows previously written via datetime.now()
+LOCAL_NOW = "strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')"
 
 # Database setup
+def connect():
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    # WAL with synchronous=NORMAL skips the per-commit fsync of the default rollback journal
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    return conn
+
+@st.cache_resource
+def get_conn():
+    # One long-lived write connection per process, shared across reruns and the background writer
+    return connect()
+
+@st.cache_resource
+def get_read_conn():
+    # Separate connection for reads so they never see the writer's uncommitted transaction
+    conn = connect()
+    conn.execute("PRAGMA query_only=ON")
+    return conn
+
+@st.cache_resource
+def get_write_lock():
+    return threading.Lock()
+
+# Schema DDL only needs to run once per process, not on every rerun
+@st.cache_resource
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_conn()
     c = conn.cursor()
     # Create tables if they don't exist
-    c.execute('''
+    c.execute(f'''
         CREATE TABLE IF NOT EXISTS chat_sessions (
             session_id TEXT PRIMARY KEY,
-            created_at TIMESTAMP,
-            last_updated TIMESTAMP
+            created_at TIMESTAMP DEFAULT ({LOCAL_NOW}),
+            last_updated TIMESTAMP DEFAULT ({LOCAL_NOW})
         )
     ''')
-    c.execute('''
+    c.execute(f'''
         CREATE TABLE IF NOT EXISTS messages (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             session_id TEXT,
             role TEXT,
             content TEXT,
-            timestamp TIMESTAMP,
+            timestamp TIMESTAMP DEFAULT ({LOCAL_NOW}),
             FOREIGN KEY (session_id) REFERENCES chat_sessions (session_id)
         )
     ''')
+    # Indexes for per-session history and first-user-message lookups
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_sid_ts
+        ON messages (session_id, timestamp)
+    ''')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_sid_role_ts
+        ON messages (session_id, role, timestamp)
+    ''')
     conn.commit()
-    conn.close()
 
 def save_message(session_id, role, content):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    current_time = datetime.now()
-    
-    # Insert message
-    c.execute('''
-        INSERT INTO messages (session_id, role, content, timestamp)
-        VALUES (?, ?, ?, ?)
-    ''', (session_id, role, content, current_time))
+    save_messages_bulk(session_id, [(role, content)])
+
+def write_messages(rows):
+    conn = get_conn()
+    # All writes share one transaction; the connection context manager commits once on exit
+    with get_write_lock(), conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        
+        # Insert messages
+        c.executemany(f'''
+            INSERT INTO messages (session_id, role, content, timestamp)
+            VALUES (?, ?, ?, {LOCAL_NOW})
+        ''', rows)
+        
+        # Update session last_updated
+        c.executemany(f'''
+            UPDATE chat_sessions SET last_updated = {LOCAL_NOW}
+            WHERE session_id = ?
+        ''', [(session_id,) for session_id in {row[0] for row in rows}])
+
+def write_messages_with_retry(rows):
+    # Retry in place rather than re-queueing so the batch stays ahead of newer messages
+    for attempt in range(WRITE_RETRIES):
+        try:
+            write_messages(rows)
+            return True
+        except Exception:
+            logger.exception(f"Failed to save messages (attempt {attempt + 1} of {WRITE_RETRIES})")
+            if attempt + 1 < WRITE_RETRIES:
+                time.sleep(WRITE_RETRY_BACKOFF * 2 ** attempt)
+    return False
+
+@st.cache_resource
+def get_dropped_writes():
+    # session_id -> number of messages the writer gave up on, reported on that session's next rerun
+    return collections.Counter(), threading.Lock()
+
+def record_dropped_writes(rows):
+    dropped, lock = get_dropped_writes()
+    with lock:
+        dropped.update(row[0] for row in rows)
+
+def pop_dropped_writes(session_id):
+    dropped, lock = get_dropped_writes()
+    with lock:
+        return dropped.pop(session_id, 0)
+
+@st.cache_resource
+def get_writer():
+    # Single background writer that folds queued messages into one commit per batch window
+    q = queue.Queue()
     
-    # Update session last_updated
-    c.execute('''
-        UPDATE chat_sessions SET last_updated = ?
-        WHERE session_id = ?
-    ''', (current_time, session_id))
+    def loop():
+        while True:
+            batch = [q.get()]
+            deadline = time.monotonic() + WRITE_BATCH_WINDOW
+            while (timeout := deadline - time.monotonic()) > 0:
+                try:
+                    batch.append(q.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            rows = [row for item in batch for row in item]
+            # No exception may escape, or the writer dies and the queue is never drained
+            try:
+                if write_messages_with_retry(rows):
+                    try:
+                        get_session_messages.clear()
+                        get_all_sessions.clear()
+                    except Exception:
+                        logger.exception("Failed to clear cached history")
+                else:
+                    # Out of retries: the script thread reports this and resyncs from the database
+                    record_dropped_writes(rows)
+            finally:
+                for _ in batch:
+                    q.task_done()
     
-    conn.commit()
-    conn.close()
+    threading.Thread(target=loop, daemon=True).start()
+    # Drain pending writes before the process exits
+    atexit.register(q.join)
+    return q
+
+def save_messages_bulk(session_id, messages):
+    # Hand off to the background writer so rendering never waits on a commit
+    get_writer().put([(session_id, role, content) for role, content in messages])
 
 def create_new_session():
     session_id = str(uuid.uuid4())
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    current_time = datetime.now()
-    c.execute('''
-        INSERT INTO chat_sessions (session_id, created_at, last_updated)
-        VALUES (?, ?, ?)
-    ''', (session_id, current_time, current_time))
-    conn.commit()
-    conn.close()
+    conn = get_conn()
+    # The connection context manager commits, or rolls back so the shared connection isn't left mid-transaction
+    with get_write_lock(), conn:
+        c = conn.cursor()
+        c.execute(f'''
+            INSERT INTO chat_sessions (session_id, created_at, last_updated)
+            VALUES (?, {LOCAL_NOW}, {LOCAL_NOW})
+        ''', (session_id,))
+    get_all_sessions.clear()
     return session_id
 
-def get_session_messages(session_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+@st.cache_data(ttl=30, show_spinner=False)
+def get_session_messages(session_id, limit=HISTORY_PAGE_SIZE, offset=0):
+    c = get_read_conn().cursor()
+    # Read one page counting back from the newest message, then restore chronological order
     c.execute('''
         SELECT role, content FROM messages 
         WHERE session_id = ?
-        ORDER BY timestamp
-    ''', (session_id,))
-    messages = [{"role": role, "content": content} for role, content in c.fetchall()]
-    conn.close()
+        ORDER BY timestamp DESC, id DESC
+        LIMIT ? OFFSET ?
+    ''', (session_id, limit, offset))
+    # Plain (role, content) row tuples; no per-row dict construction
+    messages = c.fetchall()
+    messages.reverse()
     return messages
 
-def get_first_user_message(session_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-        SELECT content FROM messages 
-        WHERE session_id = ? AND role = 'user'
-        ORDER BY timestamp
-        LIMIT 1
-    ''', (session_id,))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else ""
-
+@st.cache_data(ttl=30, show_spinner=False)
 def get_all_sessions():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    # Only get sessions that have messages
+    c = get_read_conn().cursor()
+    # Only get sessions that have messages, along with each session's first user message
     c.execute('''
-        SELECT DISTINCT chat_sessions.session_id, chat_sessions.created_at, chat_sessions.last_updated 
-        FROM chat_sessions 
-        INNER JOIN messages ON chat_sessions.session_id = messages.session_id
-        ORDER BY chat_sessions.last_updated DESC
+        SELECT s.session_id, s.created_at, s.last_updated,
+               (SELECT m.content FROM messages m
+                 WHERE m.session_id = s.session_id AND m.role = 'user'
+                 ORDER BY m.timestamp, m.id
+                 LIMIT 1) AS first_message
+        FROM chat_sessions s
+        WHERE EXISTS (SELECT 1 FROM messages m2 WHERE m2.session_id = s.session_id)
+        ORDER BY s.last_updated DESC
     ''')
     sessions = c.fetchall()
-    conn.close()
     return sessions
 
 # Load environment variables
@@ -112,25 +235,41 @@ WEBHOOK_URL = os.getenv("N8N_WEBHOOK_URL")
 BEARER_TOKEN = os.getenv("BEARER_TOKEN")
 DB_PATH = os.getenv("DB_PATH")
 
-def send_message(message):
+@st.cache_resource
+def get_http_session():
     """
-    Send message to n8n webhook and return the response
+    Shared keep-alive HTTP session so each message reuses the webhook connection
     """
-    headers = {
+    session = requests.Session()
+    session.headers.update({
         "Authorization": f"Bearer {BEARER_TOKEN}",
         "Content-Type": "application/json"
-    }
-    
+    })
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def encode_payload(payload):
+    # Serialize once up front and send raw bytes; orjson is used when installed
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode()
+
+def send_message(message):
+    """
+    Send message to n8n webhook and return the response
+    """
     payload = {
         "sessionId": st.session_state.session_id,
         "chatInput": message
     }
     
     try:
-        response = requests.post(
+        response = get_http_session().post(
             WEBHOOK_URL,
-            headers=headers,
-            json=payload
+            data=encode_payload(payload),
+            timeout=(3.05, 60)
         )
         response.raise_for_status()
         return response.json()["output"]
@@ -146,6 +285,20 @@ if 'session_id' not in st.session_state:
     st.session_state.session_id = create_new_session()
 if 'messages' not in st.session_state:
     st.session_state.messages = []
+if 'loaded_session' not in st.session_state:
+    st.session_state.loaded_session = st.session_state.session_id
+if 'history_limit' not in st.session_state:
+    st.session_state.history_limit = HISTORY_PAGE_SIZE
+if 'has_more_history' not in st.session_state:
+    st.session_state.has_more_history = False
+
+# Report messages the background writer failed to save, and reload the history so it matches the database
+if dropped := pop_dropped_writes(st.session_state.session_id):
+    st.error(f"{dropped} message(s) could not be saved to the database.")
+    get_session_messages.clear()
+    st.session_state.messages = get_session_messages(st.session_state.session_id)
+    st.session_state.history_limit = HISTORY_PAGE_SIZE
+    st.session_state.has_more_history = len(st.session_state.messages) == HISTORY_PAGE_SIZE
 
 # Sidebar for chat history
 with st.sidebar:
@@ -155,34 +308,53 @@ with st.sidebar:
     if st.button("Start New Chat"):
         st.session_state.session_id = create_new_session()
         st.session_state.messages = []
+        st.session_state.loaded_session = st.session_state.session_id
+        st.session_state.history_limit = HISTORY_PAGE_SIZE
+        st.session_state.has_more_history = False
         st.rerun()
     
     # Display chat sessions
     sessions = get_all_sessions()
-    for session_id, created_at, last_updated in sessions:
-        first_message = get_first_user_message(session_id)
+    for session_id, created_at, last_updated, first_message in sessions:
+        first_message = first_message or ""
         # Truncate message to 50 characters and add ellipsis if needed
         display_text = (first_message[:24] + "...") if len(first_message) > 27 else first_message
         
         if st.button(display_text, key=session_id):
-            st.session_state.session_id = session_id
-            st.session_state.messages = get_session_messages(session_id)
+            # Only hit the database when switching to a different session
+            if st.session_state.loaded_session != session_id:
+                st.session_state.session_id = session_id
+                st.session_state.messages = get_session_messages(session_id)
+                st.session_state.loaded_session = session_id
+                st.session_state.history_limit = HISTORY_PAGE_SIZE
+                st.session_state.has_more_history = len(st.session_state.messages) == HISTORY_PAGE_SIZE
             st.rerun()
 
 # Main chat interface
 st.title("Chat Interface")
 
+# Older history is only rendered, and fetched if needed, on request
+if st.session_state.has_more_history or len(st.session_state.messages) > st.session_state.history_limit:
+    if st.button("Load earlier messages"):
+        st.session_state.history_limit += HISTORY_PAGE_SIZE
+        if st.session_state.has_more_history and len(st.session_state.messages) < st.session_state.history_limit:
+            older = get_session_messages(st.session_state.session_id, offset=len(st.session_state.messages))
+            st.session_state.messages = older + st.session_state.messages
+            st.session_state.has_more_history = len(older) == HISTORY_PAGE_SIZE
+        st.rerun()
+
 # Display chat messages
-for message in st.session_state.messages:
-    with st.chat_message(message["role"]):
-        st.write(message["content"])
+for role, content in st.session_state.messages[-st.session_state.history_limit:]:
+    with st.chat_message(role):
+        st.write(content)
 
 # Chat input
 if prompt := st.chat_input("Enter your message"):
     # Display user message
     with st.chat_message("user"):
         st.write(prompt)
-    st.session_state.messages.append({"role": "user", "content": prompt})
+    st.session_state.messages.append(("user", prompt))
+    # Queue the prompt before the webhook call so it is kept even if this run is cut short
     save_message(st.session_state.session_id, "user", prompt)
     
     # Get and display assistant response
@@ -191,5 +363,5 @@ if prompt := st.chat_input("Enter your message"):
             response = send_message(prompt)
             if response:
                 st.write(response)
-                st.session_state.messages.append({"role": "assistant", "content": response})
+                st.session_state.messages.append(("assistant", response))
                 save_message(st.session_state.session_id, "assistant", response)
\ No newline at end of file